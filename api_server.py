@@ -1,12 +1,16 @@
-import json
+import asyncio
 import os
-from typing import List
+import threading
+from typing import Dict, List, Optional
 import logging
-from datetime import datetime
+
+import aiofiles
+import orjson
 
 # Import FastAPI and Pydantic for building the API and validating data
-from fastapi import FastAPI, HTTPException, status
-from pydantic import BaseModel, Field, validator
+from fastapi import FastAPI, HTTPException, Query, status
+from fastapi.concurrency import run_in_threadpool
+from pydantic import BaseModel, Field, field_validator
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -20,20 +24,22 @@ class Student(BaseModel):
     rollNo: str = Field(..., min_length=1, description="Student roll number")
     url: str = Field(..., min_length=1, description="Student URL/profile link")
     
-    @validator('rollNo')
+    @field_validator('rollNo')
+    @classmethod
     def validate_roll_no(cls, v):
         if not v.strip():
             raise ValueError('rollNo cannot be empty or whitespace')
         return v.strip()
     
-    @validator('url')
+    @field_validator('url')
+    @classmethod
     def validate_url(cls, v):
         if not v.strip():
             raise ValueError('url cannot be empty or whitespace')
         return v.strip()
 
 class StudentPayload(BaseModel):
-    classStudents: List[Student] = Field(..., min_items=1, description="List of students")
+    classStudents: List[Student] = Field(..., min_length=1, description="List of students")
 
 # --- 2. Initialize the FastAPI application ---
 app = FastAPI(
@@ -45,35 +51,59 @@ app = FastAPI(
 # The name of the file where we will store the student data.
 STUDENTS_DATA_FILE = 'students_data.json'
 
+# In-memory roster keyed by the canonical rollNo (see roll_no_key). It is loaded from the file once
+# at startup and is the source of truth while the server runs.
+STUDENTS: Dict[str, dict] = {}
+# Batches are applied in the threadpool, so roster access is guarded by a lock.
+STUDENTS_LOCK = threading.Lock()
+
+# Roster keys that are not on disk yet, mapped to the number of requests waiting on
+# their save (the request that added the student plus any that were told it exists).
+# If a save fails, a student is only removed again once no request is waiting on it.
+UNSAVED_KEYS: Dict[str, int] = {}
+
+# Writes of the roster are funnelled through a single writer task. Requests put
+# a (future, keys) pair on this queue; the writer drains everything queued, writes
+# the file once and resolves all of those futures with the outcome.
+PENDING_WRITES: Optional[asyncio.Queue] = None
+writer_task: Optional[asyncio.Task] = None
+
 # --- 3. Helper Functions ---
-def load_existing_data():
+def roll_no_key(roll_no):
+    """Return the canonical, case-insensitive key for a roll number."""
+    return roll_no.casefold()
+
+async def load_existing_data():
     """Load existing student data from JSON file."""
     if os.path.exists(STUDENTS_DATA_FILE):
         try:
-            with open(STUDENTS_DATA_FILE, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                # Ensure the data has the expected structure
-                if not isinstance(data, dict) or 'classStudents' not in data:
-                    logger.warning("Invalid data structure in file, initializing new structure")
-                    return {"classStudents": []}
-                return data
-        except (json.JSONDecodeError, FileNotFoundError) as e:
+            async with aiofiles.open(STUDENTS_DATA_FILE, 'rb') as f:
+                raw = await f.read()
+            data = orjson.loads(raw)
+            # Ensure the data has the expected structure
+            if not isinstance(data, dict) or 'classStudents' not in data:
+                logger.warning("Invalid data structure in file, initializing new structure")
+                return {"classStudents": []}
+            return data
+        except (orjson.JSONDecodeError, FileNotFoundError) as e:
             logger.error(f"Error loading existing data: {e}")
             return {"classStudents": []}
     else:
         return {"classStudents": []}
 
-def save_data_to_file(data):
+async def save_data_to_file(data):
     """Save data to JSON file with error handling."""
     try:
-        # Create backup of existing file if it exists
-        if os.path.exists(STUDENTS_DATA_FILE):
-            backup_name = f"{STUDENTS_DATA_FILE}.backup.{datetime.now().strftime('%Y%m%d_%H%M%S')}"
-            os.rename(STUDENTS_DATA_FILE, backup_name)
-            logger.info(f"Created backup: {backup_name}")
-        
-        with open(STUDENTS_DATA_FILE, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=2, ensure_ascii=False)
+        # Serialize up front so the file is written in a single call
+        payload_bytes = orjson.dumps(data)
+
+        # Write to a temp file and swap it in atomically, so readers never see
+        # a partially written file and a crash leaves the previous version intact
+        temp_file = STUDENTS_DATA_FILE + '.tmp'
+        async with aiofiles.open(temp_file, 'wb') as f:
+            await f.write(payload_bytes)
+            await f.flush()
+        os.replace(temp_file, STUDENTS_DATA_FILE)
         
         logger.info(f"Successfully saved data to {STUDENTS_DATA_FILE}")
         return True
@@ -81,7 +111,126 @@ def save_data_to_file(data):
         logger.error(f"Failed to save data: {e}")
         return False
 
-# --- 4. API Endpoints ---
+def apply_batch(incoming, debug=False):
+    """
+    Adds incoming students to the in-memory roster, skipping duplicates.
+    Within a payload the first occurrence of a roll number wins.
+    Returns: tuple (added_count, held_keys, skipped_count, added_students, skipped_students),
+    where held_keys are the added students plus duplicates of students not saved yet;
+    the request must wait for their save before reporting success.
+    """
+    keys = [roll_no_key(student.rollNo) for student in incoming]
+    # Index of the first occurrence of each key (reversed so earlier entries overwrite later ones)
+    first_index = dict(zip(reversed(keys), reversed(range(len(keys)))))
+
+    # Serialize outside the lock; the event loop takes the same lock to read the roster
+    candidates = {key: incoming[i].model_dump() for key, i in first_index.items()}
+
+    with STUDENTS_LOCK:
+        new_keys = candidates.keys() - STUDENTS.keys()
+        STUDENTS.update({key: candidates[key] for key in new_keys})
+        held_keys = [key for key in candidates if key in new_keys or key in UNSAVED_KEYS]
+        for key in held_keys:
+            UNSAVED_KEYS[key] = UNSAVED_KEYS.get(key, 0) + 1
+
+    new_indexes = sorted(first_index[key] for key in new_keys)
+    added_count = len(new_indexes)
+    skipped_count = len(incoming) - added_count
+    logger.info(f"Added {added_count} new student(s), skipped {skipped_count} duplicate(s)")
+
+    added_students = []
+    skipped_students = []
+    if debug:
+        added_students = [incoming[i].rollNo for i in new_indexes]
+        added_set = set(new_indexes)
+        skipped_students = [student.rollNo for i, student in enumerate(incoming) if i not in added_set]
+
+    return added_count, held_keys, skipped_count, added_students, skipped_students
+
+def release_unsaved_keys(keys):
+    """
+    Drops a request's claim on keys after its save failed. Students no other request
+    is waiting on are removed from the roster. Must be called with STUDENTS_LOCK held.
+    Returns: bool (True if all keys were already saved by an earlier write)
+    """
+    already_saved = True
+    removed = 0
+    for key in keys:
+        if key not in UNSAVED_KEYS:
+            continue
+        already_saved = False
+        UNSAVED_KEYS[key] -= 1
+        if UNSAVED_KEYS[key] == 0:
+            del UNSAVED_KEYS[key]
+            STUDENTS.pop(key, None)
+            removed += 1
+    if removed:
+        logger.warning(f"Removed {removed} student(s) that could not be saved")
+    return already_saved
+
+async def persist_students(students):
+    """Write a snapshot of the in-memory roster to the JSON file."""
+    return await save_data_to_file({"classStudents": students})
+
+async def students_writer():
+    """Coalesce queued persistence requests into one file write per batch."""
+    while True:
+        waiters = [await PENDING_WRITES.get()]
+        while not PENDING_WRITES.empty():
+            waiters.append(PENDING_WRITES.get_nowait())
+
+        with STUDENTS_LOCK:
+            students = list(STUDENTS.values())
+            saving = list(UNSAVED_KEYS)
+        success = await persist_students(students)
+        if len(waiters) > 1:
+            logger.info(f"Coalesced {len(waiters)} write request(s) into a single save")
+
+        # Settle the unsaved keys before the next snapshot is taken, so a failed
+        # batch is never removed after a later write has put it on disk
+        with STUDENTS_LOCK:
+            if success:
+                for key in saving:
+                    UNSAVED_KEYS.pop(key, None)
+                results = [True] * len(waiters)
+            else:
+                results = [release_unsaved_keys(keys) for _, keys in waiters]
+
+        for (future, _), result in zip(waiters, results):
+            if not future.done():
+                future.set_result(result)
+
+async def request_persist(keys):
+    """Queue a write of the roster and wait until keys have been flushed to disk."""
+    future = asyncio.get_running_loop().create_future()
+    await PENDING_WRITES.put((future, keys))
+    return await future
+
+# --- 4. Startup ---
+
+@app.on_event("startup")
+async def load_students_into_memory():
+    """Populate the in-memory roster from the JSON file once."""
+    data = await load_existing_data()
+    STUDENTS.clear()
+    for student in data['classStudents']:
+        STUDENTS.setdefault(roll_no_key(student['rollNo']), student)
+    logger.info(f"Loaded {len(STUDENTS)} student(s) from {STUDENTS_DATA_FILE}")
+
+@app.on_event("startup")
+async def start_students_writer():
+    """Start the single writer task that persists the roster."""
+    global PENDING_WRITES, writer_task
+    PENDING_WRITES = asyncio.Queue()
+    writer_task = asyncio.create_task(students_writer())
+
+@app.on_event("shutdown")
+async def stop_students_writer():
+    """Stop the writer task."""
+    if writer_task:
+        writer_task.cancel()
+
+# --- 5. API Endpoints ---
 
 @app.get("/")
 async def root():
@@ -99,11 +248,12 @@ async def root():
 async def get_students():
     """Get all stored student data."""
     try:
-        data = load_existing_data()
+        with STUDENTS_LOCK:
+            students = list(STUDENTS.values())
         return {
             "status": "success",
-            "total_students": len(data['classStudents']),
-            "data": data
+            "total_students": len(students),
+            "data": {"classStudents": students}
         }
     except Exception as e:
         logger.error(f"Error retrieving students: {e}")
@@ -113,41 +263,27 @@ async def get_students():
         )
 
 @app.post("/add-student")
-async def add_student_endpoint(payload: StudentPayload):
+async def add_student_endpoint(
+    payload: StudentPayload,
+    debug: bool = Query(False, description="Include the added/skipped roll numbers in the response")
+):
     """
-    Receives student data via a POST request and appends it to a JSON file.
-    Prevents duplicate entries based on rollNo.
+    Receives student data via a POST request and adds it to the roster.
+    Prevents duplicate entries based on rollNo (case-insensitive).
+    Concurrent requests share a single write of the JSON file.
     """
     try:
-        # --- Load Existing Data ---
-        data = load_existing_data()
-        
-        # Get a set of roll numbers we already have (case-insensitive comparison)
-        existing_roll_nos = {student['rollNo'].lower() for student in data['classStudents']}
-       
-        added_count = 0
-        skipped_count = 0
-        added_students = []
-        skipped_students = []
-
-        # --- Process the incoming student(s) from the payload ---
-        for student_to_add in payload.classStudents:
-            if student_to_add.rollNo.lower() not in existing_roll_nos:
-                # Add the new student to our data
-                student_dict = student_to_add.dict()
-                data['classStudents'].append(student_dict)
-                existing_roll_nos.add(student_to_add.rollNo.lower())
-                added_students.append(student_to_add.rollNo)
-                added_count += 1
-                logger.info(f"Added new student: {student_to_add.rollNo}")
-            else:
-                skipped_students.append(student_to_add.rollNo)
-                skipped_count += 1
-                logger.info(f"Skipped duplicate student: {student_to_add.rollNo}")
+        # --- Process the incoming student(s) off the event loop ---
+        added_count, held_keys, skipped_count, added_students, skipped_students = await run_in_threadpool(
+            apply_batch, payload.classStudents, debug
+        )
 
-        # --- Save the updated data back to the file ---
-        if added_count > 0:
-            success = save_data_to_file(data)
+        # --- Save the updated roster through the shared writer ---
+        # This also covers duplicates of students whose save is still in flight. If the
+        # save fails, the writer removes the students no other request is waiting on,
+        # so a retry adds (and saves) them again.
+        if held_keys:
+            success = await request_persist(held_keys)
             if not success:
                 raise HTTPException(
                     status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -162,11 +298,11 @@ async def add_student_endpoint(payload: StudentPayload):
                 "total_received": len(payload.classStudents),
                 "added_count": added_count,
                 "skipped_count": skipped_count,
-                "total_students_now": len(data['classStudents'])
+                "total_students_now": len(STUDENTS)
             }
         }
         
-        # Include details about which students were added/skipped (useful for debugging)
+        # Include details about which students were added/skipped (only with ?debug=true)
         if added_students:
             response["added_students"] = added_students
         if skipped_students:
@@ -184,7 +320,7 @@ async def add_student_endpoint(payload: StudentPayload):
             detail="An unexpected error occurred while processing the request"
         )
 
-# --- 5. Error Handlers ---
+# --- 6. Error Handlers ---
 @app.exception_handler(ValueError)
 async def value_error_handler(request, exc):
     return HTTPException(
@@ -7,18 +7,26 @@
 # ====================================================================
 
 import os
-import json
+import hashlib
+import asyncio
 import threading
+import queue
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import io
 import logging
 from typing import Optional
 
 import cv2
+import dlib
 import numpy as np
 import face_recognition
+from face_recognition.api import face_encoder, pose_predictor_5_point
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
 from fastapi import FastAPI, HTTPException, status
 from pydantic import BaseModel
 
@@ -29,6 +37,21 @@ logger = logging.getLogger(__name__)
 # --- Configuration ---
 STUDENTS_DATA_FILE = 'students_data.json' # Input file with student URLs
 ATTENDANCE_FILE = 'attendance.json'       # Output file for attendance records
+ATTENDANCE_LOG_FILE = 'attendance.jsonl'  # Append-only log of records marked during a session
+ENCODINGS_CACHE_FILE = 'encodings_cache.npz'  # Face encodings cached by rollNo + image URL
+# Face detector: dlib's CNN detector when dlib was built with CUDA, otherwise the CPU HOG detector
+FACE_DETECTION_MODEL = "cnn" if dlib.DLIB_USE_CUDA else "hog"
+MATCH_TOLERANCE = 0.5                     # Max face distance counted as a match (lower is stricter)
+TRACK_MIN_IOU = 0.5                       # Box overlap at which a face is taken to be the one recognized in the previous frame
+TRACK_MAX_AGE = 1.0                       # Seconds before a tracked face is re-encoded and re-matched
+CAMERA_INDICES = []                       # Cameras to run at once, e.g. [0, 1]; empty = first available of 0-2
+FRAME_SKIP = 3                            # Process every 3rd captured frame
+PIPELINE_QUEUE_SIZE = 2                   # Max frames waiting between pipeline stages
+DOWNLOAD_WORKERS = 16                     # Parallel student image downloads
+MAX_IMAGE_BYTES = 5 * 1024 * 1024         # Student images larger than this are not downloaded
+CNN_MAX_PHOTO_SIDE = 800                  # Student photos are downscaled to this for the CNN detector
+ATTENDANCE_FLUSH_INTERVAL = 0.5           # Seconds between attendance log flushes
+STARTUP_TIMEOUT = 30                      # Max seconds /start-recognition waits for the session to initialize
 
 # --- FastAPI App Initialization ---
 app = FastAPI(
@@ -39,15 +62,27 @@ app = FastAPI(
 
 # --- Global State Management ---
 # This dictionary will manage the state of the recognition process across API calls.
+# Whether a session is running is derived from the thread itself (see is_recognition_running).
 recognition_state = {
-    "is_running": False,
     "recognition_thread": None,
     "stop_event": None,
+    "ready_event": None,   # Set by the thread once the session is running or has failed to start
     "error_message": None,
     "start_time": None,
     "students_loaded": 0
 }
 
+# --- Attendance Buffer ---
+# The recognition loop only records attendance in memory; a flusher thread
+# appends pending records to the attendance log in batches. The log is merged
+# into the attendance file once, when the session ends.
+attendance_lock = threading.Lock()
+attendance_buffer = {
+    "date": None,                    # Day that "present" refers to (YYYY-MM-DD)
+    "present": set(),                # Roll numbers already marked on that day
+    "pending": deque(maxlen=10000)   # Records marked but not yet written to the log
+}
+
 # --- Response Models ---
 class StartResponse(BaseModel):
     status: str
@@ -65,9 +100,142 @@ class StopResponse(BaseModel):
 # REFACTORED CORE LOGIC FROM main.py
 # ====================================================================
 
+def load_encodings_cache():
+    """
+    Loads previously computed face encodings from the cache file.
+    Returns: tuple (dict mapping (rollNo, url) to a float32 encoding, source_hash)
+    """
+    if not os.path.exists(ENCODINGS_CACHE_FILE):
+        return {}, ""
+
+    try:
+        with np.load(ENCODINGS_CACHE_FILE, allow_pickle=False) as cache:
+            entries = {
+                (roll_no, url): encoding
+                for roll_no, url, encoding in zip(cache["rolls"].tolist(), cache["urls"].tolist(), cache["encodings"])
+            }
+            source_hash = str(cache["source_hash"]) if "source_hash" in cache.files else ""
+            return entries, source_hash
+    except Exception as e:
+        logger.warning(f"Could not read {ENCODINGS_CACHE_FILE}, all students will be re-encoded: {e}")
+        return {}, ""
+
+def save_encodings_cache(entries, source_hash=""):
+    """
+    Saves face encodings to the cache file as a single contiguous float32 matrix.
+    entries: dict mapping (rollNo, url) to an encoding
+    source_hash: hash of the student data the entries fully cover, or "" if incomplete
+    """
+    try:
+        keys = list(entries)
+        temp_file = ENCODINGS_CACHE_FILE + '.tmp'
+        with open(temp_file, 'wb') as f:
+            np.savez(
+                f,
+                rolls=np.array([roll_no for roll_no, _ in keys], dtype=str),
+                urls=np.array([url for _, url in keys], dtype=str),
+                encodings=np.asarray(list(entries.values()), dtype=np.float32).reshape(-1, 128),
+                source_hash=np.array(source_hash)
+            )
+        os.replace(temp_file, ENCODINGS_CACHE_FILE)
+        logger.info(f"Saved {len(keys)} encodings to {ENCODINGS_CACHE_FILE}")
+    except Exception as e:
+        logger.warning(f"Could not write {ENCODINGS_CACHE_FILE}: {e}")
+
+def has_image_signature(data):
+    """
+    Returns True if data starts with the magic bytes of a JPEG, PNG, WebP or BMP file.
+    """
+    return (
+        data[:3] == b'\xff\xd8\xff'
+        or data[:8] == b'\x89PNG\r\n\x1a\n'
+        or (data[:4] == b'RIFF' and data[8:12] == b'WEBP')
+        or data[:2] == b'BM'
+    )
+
+def download_student_image(roll_no, url, session=requests):
+    """
+    Downloads and decodes a student's image, using session's connection pool if given.
+    Downloads larger than MAX_IMAGE_BYTES are aborted.
+    Returns: the image as a BGR ndarray, or None if it could not be used
+    """
+    try:
+        # Download image with better error handling
+        with session.get(url, timeout=15, stream=True) as response:
+            response.raise_for_status()
+
+            # Check if response content is actually an image
+            content_type = response.headers.get('content-type', '').lower()
+            if not content_type.startswith('image/'):
+                logger.warning(f"Warning: URL for {roll_no} doesn't seem to be an image (content-type: {content_type}). Skipping.")
+                return None
+
+            content_length = response.headers.get('content-length', '')
+            if content_length.isdigit() and int(content_length) > MAX_IMAGE_BYTES:
+                logger.warning(f"Warning: Image for {roll_no} is too large ({content_length} bytes). Skipping.")
+                return None
+
+            # Stream the body so an oversized download is abandoned as soon as it passes the limit
+            content = bytearray()
+            for chunk in response.iter_content(chunk_size=65536):
+                content += chunk
+                if len(content) > MAX_IMAGE_BYTES:
+                    logger.warning(f"Warning: Image for {roll_no} is larger than {MAX_IMAGE_BYTES} bytes. Skipping.")
+                    return None
+
+        # Reject anything that isn't an image format before handing it to the decoder
+        if not has_image_signature(content):
+            logger.warning(f"Warning: Data downloaded for {roll_no} is not a supported image format. Skipping.")
+            return None
+
+        # Convert image data from bytes to an OpenCV image
+        image_bytes = np.frombuffer(content, np.uint8)
+        img = cv2.imdecode(image_bytes, cv2.IMREAD_COLOR)
+
+        if img is None:
+            logger.warning(f"Warning: Could not decode image for {roll_no}. Invalid image format. Skipping.")
+            return None
+
+        # Check if image is too small
+        if img.shape[0] < 50 or img.shape[1] < 50:
+            logger.warning(f"Warning: Image for {roll_no} is too small ({img.shape[:2]}). Skipping.")
+            return None
+
+        return img
+
+    except requests.exceptions.Timeout:
+        logger.error(f"Timeout downloading image for {roll_no}")
+    except requests.exceptions.RequestException as e:
+        logger.error(f"Error downloading image for {roll_no}: {e}")
+    except Exception as e:
+        logger.error(f"An error occurred while downloading {roll_no}: {e}")
+    return None
+
+def locate_student_face(rgb_img):
+    """
+    Finds the face locations in a student's photo. The CNN detector upsamples its input,
+    so large photos are searched at CNN_MAX_PHOTO_SIDE and the boxes are mapped back
+    to the full-size photo, which is what gets encoded.
+    Returns: list of (top, right, bottom, left) tuples in rgb_img coordinates
+    """
+    height, width = rgb_img.shape[:2]
+    scale = CNN_MAX_PHOTO_SIDE / max(height, width)
+    if FACE_DETECTION_MODEL != "cnn" or scale >= 1:
+        return face_recognition.face_locations(rgb_img, model=FACE_DETECTION_MODEL)
+
+    small_img = cv2.resize(rgb_img, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA)
+    return [
+        (
+            max(int(top / scale), 0), min(int(right / scale), width),
+            min(int(bottom / scale), height), max(int(left / scale), 0)
+        )
+        for top, right, bottom, left in face_recognition.face_locations(small_img, model="cnn")
+    ]
+
 def load_and_encode_students():
     """
     Loads student data from JSON, downloads images from URLs, and generates face encodings.
+    Encodings are cached on disk, so only new or changed students are downloaded and encoded.
     Returns: tuple (known_face_encodings, known_student_roll_nos, error_message)
     """
     logger.info("Loading student data and generating encodings...")
@@ -81,9 +249,16 @@ def load_and_encode_students():
         return [], [], error_msg
 
     try:
-        with open(STUDENTS_DATA_FILE, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-    except (json.JSONDecodeError, FileNotFoundError) as e:
+        with open(STUDENTS_DATA_FILE, 'rb') as f:
+            raw = f.read()
+    except FileNotFoundError as e:
+        error_msg = f"Error reading {STUDENTS_DATA_FILE}: {e}"
+        logger.error(error_msg)
+        return [], [], error_msg
+
+    try:
+        data = orjson.loads(raw)
+    except orjson.JSONDecodeError as e:
         error_msg = f"Error reading {STUDENTS_DATA_FILE}: {e}"
         logger.error(error_msg)
         return [], [], error_msg
@@ -94,6 +269,17 @@ def load_and_encode_students():
         logger.error(error_msg)
         return [], [], error_msg
 
+    # Fast path: the cache was built from exactly this student list. The hash is taken
+    # over the canonical JSON, so reformatting the file doesn't invalidate the cache.
+    source_hash = hashlib.sha256(orjson.dumps(students, option=orjson.OPT_SORT_KEYS)).hexdigest()
+    cached_encodings, cached_hash = load_encodings_cache()
+    if cached_encodings and cached_hash == source_hash:
+        logger.info(f"--- Student data unchanged. {len(cached_encodings)} encodings loaded from cache. ---")
+        return list(cached_encodings.values()), [roll_no for roll_no, _ in cached_encodings], None
+
+    encodings_by_key = {}
+
+    to_download = []
     for i, student in enumerate(students):
         roll_no = student.get("rollNo")
         url = student.get("url")
@@ -102,97 +288,193 @@ def load_and_encode_students():
             logger.warning(f"Student {i+1}: Missing rollNo or URL. Skipping.")
             continue
 
-        try:
-            logger.info(f"Processing {roll_no} ({i+1}/{len(students)}) - Downloading image...")
-            
-            # Download image with better error handling
-            response = requests.get(url, timeout=15, stream=True)
-            response.raise_for_status()
+        cached = cached_encodings.get((roll_no, url))
+        if cached is not None:
+            known_face_encodings.append(cached)
+            known_student_roll_nos.append(roll_no)
+            encodings_by_key[(roll_no, url)] = cached
+        else:
+            to_download.append((roll_no, url))
 
-            # Check if response content is actually an image
-            content_type = response.headers.get('content-type', '').lower()
-            if not content_type.startswith('image/'):
-                logger.warning(f"Warning: URL for {roll_no} doesn't seem to be an image (content-type: {content_type}). Skipping.")
-                continue
+    if to_download:
+        logger.info(f"Downloading images for {len(to_download)} student(s)...")
 
-            # Convert image data from bytes to an OpenCV image
-            image_bytes = np.frombuffer(response.content, np.uint8)
-            img = cv2.imdecode(image_bytes, cv2.IMREAD_COLOR)
+    # Downloads run in parallel over one session, so connections to the image host are reused;
+    # images are encoded here, in order, as their downloads complete
+    adapter = HTTPAdapter(pool_connections=DOWNLOAD_WORKERS, pool_maxsize=DOWNLOAD_WORKERS)
+    with requests.Session() as session, ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        images = executor.map(lambda student: download_student_image(*student, session), to_download)
 
+        for (roll_no, url), img in zip(to_download, images):
             if img is None:
-                logger.warning(f"Warning: Could not decode image for {roll_no}. Invalid image format. Skipping.")
                 continue
 
-            # Check if image is too small
-            if img.shape[0] < 50 or img.shape[1] < 50:
-                logger.warning(f"Warning: Image for {roll_no} is too small ({img.shape[:2]}). Skipping.")
-                continue
+            try:
+                # Convert from BGR (OpenCV) to RGB (face_recognition)
+                rgb_img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+                
+                # Get face encoding with better error handling
+                face_locations = locate_student_face(rgb_img)
+                encodings = face_recognition.face_encodings(rgb_img, face_locations)
+                
+                if encodings:
+                    encoding = encodings[0].astype(np.float32)  # Same dtype as cached encodings
+                    known_face_encodings.append(encoding)
+                    known_student_roll_nos.append(roll_no)
+                    encodings_by_key[(roll_no, url)] = encoding
+                    logger.info(f"✓ Encoding generated for {roll_no}")
+                else:
+                    logger.warning(f"Warning: No face found in image for {roll_no}. Make sure the image clearly shows a face.")
 
-            # Convert from BGR (OpenCV) to RGB (face_recognition)
-            rgb_img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-            
-            # Get face encoding with better error handling
-            encodings = face_recognition.face_encodings(rgb_img)
-            
-            if encodings:
-                known_face_encodings.append(encodings[0])
-                known_student_roll_nos.append(roll_no)
-                logger.info(f"✓ Encoding generated for {roll_no}")
-            else:
-                logger.warning(f"Warning: No face found in image for {roll_no}. Make sure the image clearly shows a face.")
+            except Exception as e:
+                logger.error(f"An error occurred while processing {roll_no}: {e}")
 
-        except requests.exceptions.Timeout:
-            logger.error(f"Timeout downloading image for {roll_no}")
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Error downloading image for {roll_no}: {e}")
-        except Exception as e:
-            logger.error(f"An error occurred while processing {roll_no}: {e}")
+    # Only a cache that covers every downloadable student may take the fast path next time,
+    # otherwise students whose download failed would never be retried
+    new_hash = source_hash if all(key in encodings_by_key for key in to_download) else ""
+
+    # Rewrite the cache only when the encoded students (or their source) changed
+    if encodings_by_key.keys() != cached_encodings.keys() or new_hash != cached_hash:
+        save_encodings_cache(encodings_by_key, new_hash)
 
     success_count = len(known_face_encodings)
-    logger.info(f"--- Encoding complete. {success_count}/{len(students)} students loaded successfully. ---")
+    cached_count = len(encodings_by_key.keys() & cached_encodings.keys())
+    logger.info(f"--- Encoding complete. {success_count}/{len(students)} students loaded successfully ({cached_count} from cache). ---")
     
     if success_count == 0:
         return [], [], "No valid face encodings could be generated from the provided images"
     
     return known_face_encodings, known_student_roll_nos, None
 
-def mark_student_attendance(student_roll_no):
+def read_attendance_file():
+    """
+    Reads the attendance file.
+    Returns: dict with a "recognizedStudents" list
+    """
+    attendance_data = {"recognizedStudents": []}
+    if os.path.exists(ATTENDANCE_FILE):
+        with open(ATTENDANCE_FILE, 'rb') as f:
+            content = f.read().strip()
+            if content:
+                attendance_data = orjson.loads(content)
+    return attendance_data
+
+def read_attendance_log():
+    """
+    Reads the records in the attendance log. Lines that can't be parsed, such as a
+    record cut short when a session was killed mid-write, are logged and skipped.
+    Returns: list of attendance records
+    """
+    records = []
+    if not os.path.exists(ATTENDANCE_LOG_FILE):
+        return records
+    with open(ATTENDANCE_LOG_FILE, 'rb') as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                records.append(orjson.loads(line))
+            except orjson.JSONDecodeError:
+                logger.warning(f"Skipping unreadable line {line_number} in {ATTENDANCE_LOG_FILE}: {line[:80]!r}")
+    return records
+
+def open_attendance_log():
+    """
+    Opens the attendance log for appending. If the log ends in a partial line, a newline
+    is written first so new records don't run into it.
+    Returns: binary file object positioned at the end of the log
+    """
+    log_file = open(ATTENDANCE_LOG_FILE, 'ab')
+    if log_file.tell() > 0:
+        with open(ATTENDANCE_LOG_FILE, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b'\n':
+                log_file.write(b'\n')
+    return log_file
+
+def compact_attendance():
+    """
+    Merges the attendance log into the attendance file (atomic write) and removes the log.
+    Returns: bool (True if the attendance file is up to date)
+    """
+    if not os.path.exists(ATTENDANCE_LOG_FILE):
+        return True
+
+    try:
+        attendance_data = read_attendance_file()
+        new_records = read_attendance_log()
+        attendance_data.setdefault("recognizedStudents", []).extend(new_records)
+
+        # Write to a temp file, then replace atomically
+        temp_file = ATTENDANCE_FILE + '.tmp'
+        with open(temp_file, 'wb') as f:
+            f.write(orjson.dumps(attendance_data, option=orjson.OPT_INDENT_2))
+        os.replace(temp_file, ATTENDANCE_FILE)
+        os.remove(ATTENDANCE_LOG_FILE)
+
+        logger.info(f"Merged {len(new_records)} attendance record(s) into {ATTENDANCE_FILE}")
+        return True
+    except Exception as e:
+        logger.error(f"Error merging attendance log: {e}")
+        return False
+
+def load_attendance_data():
+    """
+    Prepares the in-memory attendance buffer at the start of a recognition session.
+    A log left behind by an interrupted session is merged first.
+    """
+    merged = compact_attendance()
+
+    current_date = datetime.now().strftime('%Y-%m-%d')
+    present = set()
+    try:
+        records = read_attendance_file().get("recognizedStudents", [])
+        if not merged:
+            # The log is still there; its students are present too
+            records = records + read_attendance_log()
+        present = {
+            rec.get("rollNo")
+            for rec in records
+            if rec.get("timestamp", "").startswith(current_date)
+        }
+    except Exception as e:
+        logger.error(f"Error loading attendance file: {e}")
+
+    with attendance_lock:
+        attendance_buffer["date"] = current_date
+        attendance_buffer["present"] = present
+        attendance_buffer["pending"].clear()
+
+def mark_student_attendance(student_roll_no, now: Optional[datetime] = None):
     """
-    Marks attendance in the JSON file, preventing duplicate entries for the same day.
+    Marks attendance in the in-memory buffer, preventing duplicate entries for the same day.
+    now is the time the student was seen (defaults to the current time); callers marking
+    several students from one frame pass the same value for all of them.
+    The record is appended to the attendance log by the next flush.
     Returns: bool (True if marked, False if already present)
     """
     try:
-        attendance_data = {"recognizedStudents": []}
-        
-        # Load existing attendance data
-        if os.path.exists(ATTENDANCE_FILE):
-            with open(ATTENDANCE_FILE, 'r', encoding='utf-8') as f:
-                content = f.read().strip()
-                if content:
-                    attendance_data = json.loads(content)
-
-        current_date = datetime.now().strftime('%Y-%m-%d')
-        
-        # Check if student is already marked present today
-        already_present = any(
-            rec.get("rollNo") == student_roll_no and rec.get("timestamp", "").startswith(current_date)
-            for rec in attendance_data.get("recognizedStudents", [])
-        )
+        now = now or datetime.now()
+        current_date = now.date().isoformat()  # Same as strftime('%Y-%m-%d'), without the formatting cost
+
+        with attendance_lock:
+            # A new day has started during the session
+            if attendance_buffer["date"] != current_date:
+                attendance_buffer["date"] = current_date
+                attendance_buffer["present"].clear()
+
+            already_present = student_roll_no in attendance_buffer["present"]
+
+            if not already_present:
+                attendance_buffer["present"].add(student_roll_no)
+                attendance_buffer["pending"].append({
+                    "rollNo": student_roll_no,
+                    "timestamp": now.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+                })
 
         if not already_present:
-            new_record = {
-                "rollNo": student_roll_no,
-                "timestamp": datetime.now().strftime('%Y-%m-%dT%H:%M:%S.%fZ')
-            }
-            attendance_data.setdefault("recognizedStudents", []).append(new_record)
-            
-            # Save with backup
-            temp_file = ATTENDANCE_FILE + '.tmp'
-            with open(temp_file, 'w', encoding='utf-8') as f:
-                json.dump(attendance_data, f, indent=2, ensure_ascii=False)
-            
-            # Atomic replacement
-            os.replace(temp_file, ATTENDANCE_FILE)
             logger.info(f"✓ Attendance marked for {student_roll_no}")
             return True
         else:
@@ -203,11 +485,262 @@ def mark_student_attendance(student_roll_no):
         logger.error(f"Error marking attendance for {student_roll_no}: {e}")
         return False
 
-def recognition_loop(stop_event: threading.Event):
+def flush_attendance(log_file=None):
+    """
+    Appends pending attendance records to the attendance log in a single write.
+    log_file is an open binary append handle to the log; without one the log is
+    opened just for this flush.
+    Returns: bool (True if nothing is left pending)
+    """
+    with attendance_lock:
+        pending = list(attendance_buffer["pending"])
+        attendance_buffer["pending"].clear()
+
+    if not pending:
+        return True
+
+    try:
+        data = b''.join(orjson.dumps(rec) + b'\n' for rec in pending)
+        if log_file:
+            log_file.write(data)
+            log_file.flush()
+        else:
+            with open_attendance_log() as f:
+                f.write(data)
+        return True
+    except Exception as e:
+        logger.error(f"Error writing attendance log: {e}")
+        with attendance_lock:
+            attendance_buffer["pending"].extendleft(reversed(pending))  # Retry on the next flush
+        return False
+
+def attendance_flusher(stop_event: threading.Event):
+    """
+    Periodically flushes buffered attendance records until stop_event is set.
+    The log is kept open for the whole session instead of being reopened per flush.
+    """
+    try:
+        with open_attendance_log() as log_file:
+            while not stop_event.wait(ATTENDANCE_FLUSH_INTERVAL):
+                flush_attendance(log_file)
+    except Exception as e:
+        # Records stay pending and are written by the final flush when the session ends
+        logger.error(f"Error opening attendance log: {e}")
+
+def find_best_matches(face_encodings, known_matrix, known_sqnorms):
+    """
+    Finds the closest known face for each detected face with a single matrix product.
+    Uses |a - b|^2 = |a|^2 + |b|^2 - 2ab over the (faces x known) grid.
+    Returns: tuple (best_match_indices, best_match_distances)
+    """
+    probes = np.asarray(face_encodings, dtype=np.float32)
+    sq_distances = (
+        known_sqnorms[None, :]
+        + (probes * probes).sum(axis=1)[:, None]
+        - 2.0 * (probes @ known_matrix.T)
+    )
+    # argmin is the same on squared distances, so only the winners need a sqrt
+    best_match_indices = sq_distances.argmin(axis=1)
+    best_sq_distances = sq_distances[np.arange(len(probes)), best_match_indices]
+    return best_match_indices, np.sqrt(np.maximum(best_sq_distances, 0.0))
+
+def rect_to_css(rect, shape):
+    """
+    Converts a dlib rectangle to a (top, right, bottom, left) tuple clipped to the image,
+    the face location format used by face_recognition.
+    """
+    return max(rect.top(), 0), min(rect.right(), shape[1]), min(rect.bottom(), shape[0]), max(rect.left(), 0)
+
+def open_cameras():
+    """
+    Opens the cameras listed in CAMERA_INDICES, or the first camera that opens
+    among indices 0-2 when none are configured.
+    Returns: list of opened cv2.VideoCapture objects (empty if none could be opened)
+    """
+    if CAMERA_INDICES:
+        caps = []
+        for camera_index in CAMERA_INDICES:
+            cap = cv2.VideoCapture(camera_index)
+            if cap.isOpened():
+                logger.info(f"BG-THREAD: Camera {camera_index} opened successfully.")
+                caps.append(cap)
+            else:
+                logger.warning(f"BG-THREAD: Could not open camera {camera_index}.")
+                cap.release()
+        return caps
+
+    for camera_index in [0, 1, 2]:  # Try multiple camera indices
+        cap = cv2.VideoCapture(camera_index)
+        if cap.isOpened():
+            logger.info(f"BG-THREAD: Camera {camera_index} opened successfully.")
+            return [cap]
+        cap.release()
+    return []
+
+def box_iou(a, b):
+    """
+    Returns the intersection over union of two (top, right, bottom, left) face locations.
+    """
+    inter_width = min(a[1], b[1]) - max(a[3], b[3])
+    inter_height = min(a[2], b[2]) - max(a[0], b[0])
+    if inter_width <= 0 or inter_height <= 0:
+        return 0.0
+    intersection = inter_width * inter_height
+    union = (a[1] - a[3]) * (a[2] - a[0]) + (b[1] - b[3]) * (b[2] - b[0]) - intersection
+    return intersection / union
+
+def encode_faces(rgb_image, face_locations):
+    """
+    Computes the encodings of all faces in a frame. Same result as
+    face_recognition.face_encodings(), but the faces are passed to dlib's
+    encoder as one batch instead of one call per face.
+    """
+    shapes = dlib.full_object_detections()
+    for top, right, bottom, left in face_locations:
+        shapes.append(pose_predictor_5_point(rgb_image, dlib.rectangle(left, top, right, bottom)))
+    descriptors = face_encoder.compute_face_descriptor(rgb_image, shapes, 1)
+    return np.array([np.array(descriptor) for descriptor in descriptors], dtype=np.float32)
+
+def capture_frames(cap, frame_queue: queue.Queue, frame_ready: threading.Event,
+                   stop_event: threading.Event, source=0):
+    """
+    Pipeline stage 1: grabs frames from the camera and decodes only every FRAME_SKIP-th
+    frame for the detector, tagged with source (the camera's index), and sets frame_ready.
+    Frames are not decoded at all while the detector is busy, so recognition always works
+    on recent frames.
+    """
+    frame_count = 0
+    try:
+        while not stop_event.is_set():
+            # grab() only advances the stream; decoding happens in retrieve()
+            if not cap.grab():
+                logger.warning("BG-THREAD: Failed to capture frame.")
+                stop_event.wait(0.1)  # Back off before retrying, but return at once on stop
+                continue
+
+            frame_count += 1
+
+            # Skip frames for better performance (skipped frames are never decoded)
+            if frame_count % FRAME_SKIP != 0:
+                continue
+
+            # Detector is still busy with earlier frames; don't decode one it can't take
+            if frame_queue.full():
+                continue
+
+            success, frame = cap.retrieve()
+            if not success:
+                continue
+
+            try:
+                frame_queue.put_nowait((source, frame))
+                frame_ready.set()
+            except queue.Full:
+                pass  # Queue filled up since the check above
+    except Exception as e:
+        logger.error(f"BG-THREAD: Error in capture stage: {e}")
+
+def take_latest_frames(frame_queues):
+    """
+    Empties the frame queues, keeping only the newest frame of each.
+    Returns: list of (source, frame) tuples, at most one per queue
+    """
+    frames = []
+    for frame_queue in frame_queues:
+        latest = None
+        while True:
+            try:
+                latest = frame_queue.get_nowait()
+            except queue.Empty:
+                break
+        if latest is not None:
+            frames.append(latest)
+    return frames
+
+def detect_faces(frame_queues, frame_ready: threading.Event, detection_queue: queue.Queue,
+                 stop_event: threading.Event):
+    """
+    Pipeline stage 2: downsizes frames and finds face locations. Frames with at least
+    one face are passed on to the encoder with the source they came from. Each round
+    takes the newest frame of every queue in frame_queues (one queue per camera); the
+    CNN detector processes them in one call.
+    """
+    target_sizes = {}  # source -> quarter of that camera's resolution, computed from its first frame
+    hog_detector = dlib.get_frontal_face_detector() if FACE_DETECTION_MODEL == "hog" else None
+
+    while not stop_event.is_set():
+        if not frame_ready.wait(0.1):
+            continue
+        # Clear before taking frames, so a frame queued after this point sets it again
+        frame_ready.clear()
+        frames = take_latest_frames(frame_queues)
+        if not frames:
+            continue
+
+        try:
+            # Resize frames for faster processing (INTER_AREA is the cheap, alias-free downscaler)
+            small_frames = []
+            for source, frame in frames:
+                if source not in target_sizes:
+                    height, width = frame.shape[:2]
+                    target_sizes[source] = (width // 4, height // 4)
+                small_frames.append(
+                    (source, cv2.resize(frame, target_sizes[source], interpolation=cv2.INTER_AREA))
+                )
+
+            # Find faces
+            detections = []
+            if hog_detector:
+                # HOG only looks at intensity: detect on a single-channel frame and
+                # build the RGB frame for the encoder only when a face was found
+                for source, small_frame in small_frames:
+                    gray_small_frame = cv2.cvtColor(small_frame, cv2.COLOR_BGR2GRAY)
+                    face_locations = [
+                        rect_to_css(rect, gray_small_frame.shape) for rect in hog_detector(gray_small_frame, 1)
+                    ]
+                    rgb_small_frame = cv2.cvtColor(small_frame, cv2.COLOR_BGR2RGB) if face_locations else None
+                    detections.append((source, rgb_small_frame, face_locations))
+            else:
+                # The CNN detector batches only equally sized frames, so group them by camera resolution
+                batches = {}
+                for source, small_frame in small_frames:
+                    rgb_small_frame = cv2.cvtColor(small_frame, cv2.COLOR_BGR2RGB)
+                    batches.setdefault(rgb_small_frame.shape, []).append((source, rgb_small_frame))
+                for batch in batches.values():
+                    rgb_small_frames = [rgb_small_frame for _, rgb_small_frame in batch]
+                    batch_locations = face_recognition.batch_face_locations(
+                        rgb_small_frames, batch_size=len(rgb_small_frames)
+                    )
+                    detections += [
+                        (source, rgb_small_frame, face_locations)
+                        for (source, rgb_small_frame), face_locations in zip(batch, batch_locations)
+                    ]
+
+            for source, rgb_small_frame, face_locations in detections:
+                if not face_locations:
+                    continue
+                while not stop_event.is_set():
+                    try:
+                        detection_queue.put((source, rgb_small_frame, face_locations), timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+        except Exception as e:
+            logger.error(f"BG-THREAD: Error detecting faces: {e}")
+
+def recognition_loop(stop_event: threading.Event, ready_event: Optional[threading.Event] = None):
     """
     The main face recognition loop that runs in a background thread.
+    Capture and detection run in their own threads; this thread encodes the
+    detected faces, matches them and marks attendance.
+    ready_event is set once the pipeline is running, or as soon as startup fails.
     """
-    logger.info("BG-THREAD: Recognition loop starting.")
+    ready_event = ready_event or threading.Event()
+    logger.info(f"BG-THREAD: Recognition loop starting (face detection model: {FACE_DETECTION_MODEL}).")
+    workers_stop = threading.Event()
+    workers = []
+    caps = []
+    flusher_thread = None
     
     try:
         # Step 1: Load encodings
@@ -215,93 +748,141 @@ def recognition_loop(stop_event: threading.Event):
         if error_msg or not known_encodings:
             logger.error(f"BG-THREAD: {error_msg or 'No student data to process'}. Stopping thread.")
             recognition_state["error_message"] = error_msg or "No valid face encodings available"
-            recognition_state["is_running"] = False
             return
 
         recognition_state["students_loaded"] = len(known_encodings)
         logger.info(f"BG-THREAD: Successfully loaded {len(known_encodings)} student encodings.")
 
-        # Step 2: Initialize camera with retries
-        cap = None
-        for camera_index in [0, 1, 2]:  # Try multiple camera indices
-            cap = cv2.VideoCapture(camera_index)
-            if cap.isOpened():
-                logger.info(f"BG-THREAD: Camera {camera_index} opened successfully.")
-                break
-            cap.release()
-        
-        if not cap or not cap.isOpened():
+        # Stack the known encodings once into a contiguous float32 matrix for vectorized matching
+        known_matrix = np.ascontiguousarray(np.vstack(known_encodings), dtype=np.float32)
+        known_sqnorms = (known_matrix * known_matrix).sum(axis=1)
+
+        # Step 2: Initialize camera(s)
+        caps = open_cameras()
+        if not caps:
             error_msg = "Error: Could not open any camera. Please check camera connection."
             logger.error(f"BG-THREAD: {error_msg}")
             recognition_state["error_message"] = error_msg
-            recognition_state["is_running"] = False
             return
 
         # Configure camera settings for better performance
-        cap.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
-        cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
-        cap.set(cv2.CAP_PROP_FPS, 30)
+        for cap in caps:
+            # MJPG needs about half the USB bandwidth of the usual YUYV default (set before the size)
+            cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*'MJPG'))
+            cap.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
+            cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
+            cap.set(cv2.CAP_PROP_FPS, 30)
+            # Keep only the latest frame in the driver so grab() never returns a stale one
+            cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+
+        # Load existing attendance and start flushing new records in the background
+        load_attendance_data()
+        flusher_thread = threading.Thread(target=attendance_flusher, args=(workers_stop,), daemon=True)
+        flusher_thread.start()
+
+        # Step 3: Start a capture stage per camera and the detection stage(s), all feeding this encoder.
+        # HOG runs on the CPU, so each camera gets its own detector. The CNN detector runs on the
+        # GPU, so one detector takes the latest frame from every camera as a single batch.
+        detection_queue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE * len(caps))
+        frame_queues = [queue.Queue(maxsize=PIPELINE_QUEUE_SIZE) for _ in caps]
+        if FACE_DETECTION_MODEL == "cnn":
+            shared_ready = threading.Event()  # Any camera's new frame wakes the one detector
+            ready_events = [shared_ready for _ in caps]
+            detectors = [(frame_queues, shared_ready)]
+        else:
+            ready_events = [threading.Event() for _ in caps]
+            detectors = [([frame_queue], frame_ready) for frame_queue, frame_ready in zip(frame_queues, ready_events)]
+        workers += [
+            threading.Thread(
+                target=detect_faces, args=(queues, frame_ready, detection_queue, workers_stop), daemon=True
+            )
+            for queues, frame_ready in detectors
+        ]
+        workers += [
+            threading.Thread(
+                target=capture_frames, args=(cap, frame_queue, frame_ready, workers_stop, source), daemon=True
+            )
+            for source, (cap, frame_queue, frame_ready) in enumerate(zip(caps, frame_queues, ready_events))
+        ]
+        for worker in workers:
+            worker.start()
 
         logger.info("BG-THREAD: Camera initialized. Starting recognition...")
+        ready_event.set()
         
-        # Step 3: Main recognition loop with frame skipping for performance
-        frame_skip = 3  # Process every 3rd frame
-        frame_count = 0
-        
+        # Step 4: Encode detected faces and match them against the known students.
+        # Faces recognized in a camera's previous frame are tracked by box overlap and
+        # only re-encoded once their recognition is older than TRACK_MAX_AGE.
+        tracked_faces = {}  # source -> [(face_location, roll_no, recognized_at), ...]
         while not stop_event.is_set():
-            success, frame = cap.read()
-            if not success:
-                logger.warning("BG-THREAD: Failed to capture frame.")
-                time.sleep(0.1)
-                continue
-            
-            frame_count += 1
-            
-            # Skip frames for better performance
-            if frame_count % frame_skip != 0:
+            try:
+                source, rgb_small_frame, face_locations = detection_queue.get(timeout=0.1)
+            except queue.Empty:
                 continue
             
             try:
-                # Resize frame for faster processing
-                small_frame = cv2.resize(frame, (0, 0), fx=0.25, fy=0.25)
-                rgb_small_frame = cv2.cvtColor(small_frame, cv2.COLOR_BGR2RGB)
-                
-                # Find faces
-                face_locations = face_recognition.face_locations(rgb_small_frame, model="hog")  # Use HOG for speed
-                
-                if face_locations:
-                    face_encodings = face_recognition.face_encodings(rgb_small_frame, face_locations)
-
-                    for face_encoding in face_encodings:
-                        # Compare with known faces
-                        matches = face_recognition.compare_faces(known_encodings, face_encoding, tolerance=0.6)
-                        face_distances = face_recognition.face_distance(known_encodings, face_encoding)
-                        
-                        if len(face_distances) > 0:
-                            best_match_index = np.argmin(face_distances)
-
-                            if matches[best_match_index] and face_distances[best_match_index] < 0.5:  # Stricter threshold
-                                roll_no = known_roll_nos[best_match_index]
-                                mark_student_attendance(roll_no)
+                now = time.monotonic()
+                previous = [face for face in tracked_faces.get(source, []) if now - face[2] < TRACK_MAX_AGE]
+                tracked = []
+                new_locations = []
+                for location in face_locations:
+                    match = next(
+                        (face for face in previous if box_iou(face[0], location) >= TRACK_MIN_IOU), None
+                    )
+                    if match:
+                        tracked.append((location, match[1], match[2]))
+                    else:
+                        new_locations.append(location)
+
+                if new_locations:
+                    face_encodings = encode_faces(rgb_small_frame, new_locations)
+                    seen_at = datetime.now()  # One timestamp for every student marked from this frame
+
+                    # Compare all new faces with all known faces at once
+                    best_match_indices, best_match_distances = find_best_matches(
+                        face_encodings, known_matrix, known_sqnorms
+                    )
+
+                    for location, best_match_index, distance in zip(
+                        new_locations, best_match_indices, best_match_distances
+                    ):
+                        if distance < MATCH_TOLERANCE:
+                            roll_no = known_roll_nos[best_match_index]
+                            mark_student_attendance(roll_no, seen_at)
+                            tracked.append((location, roll_no, now))
+
+                tracked_faces[source] = tracked
                 
             except Exception as e:
                 logger.error(f"BG-THREAD: Error processing frame: {e}")
-            
-            # Small delay to prevent excessive CPU usage
-            time.sleep(0.05)
 
     except Exception as e:
         logger.error(f"BG-THREAD: Unexpected error in recognition loop: {e}")
         recognition_state["error_message"] = f"Recognition loop error: {str(e)}"
     
     finally:
-        # Step 4: Cleanup
-        if 'cap' in locals() and cap:
+        ready_event.set()  # Don't leave /start-recognition waiting if startup failed
+
+        # Step 5: Cleanup (stop the pipeline stages before releasing the camera)
+        workers_stop.set()
+        for worker in workers:
+            worker.join()
+        if flusher_thread:
+            flusher_thread.join()
+            flush_attendance()
+            compact_attendance()  # Merge the session log so /stop-recognition reads every record
+        for cap in caps:
             cap.release()
         cv2.destroyAllWindows()
-        recognition_state["is_running"] = False
         logger.info("BG-THREAD: Recognition loop stopped and resources released.")
 
+def is_recognition_running():
+    """
+    Returns True while the recognition thread is alive.
+    """
+    thread = recognition_state["recognition_thread"]
+    return thread is not None and thread.is_alive()
+
 # ====================================================================
 # API ENDPOINTS
 # ====================================================================
@@ -311,7 +892,7 @@ def root():
     return {
         "message": "Face Recognition Attendance Controller is running.",
         "version": "1.0.0",
-        "is_recognition_active": recognition_state["is_running"],
+        "is_recognition_active": is_recognition_running(),
         "students_loaded": recognition_state.get("students_loaded", 0),
         "start_time": recognition_state.get("start_time"),
         "endpoints": {
@@ -325,7 +906,7 @@ def root():
 def get_status():
     """Get current status of the recognition system."""
     return {
-        "is_running": recognition_state["is_running"],
+        "is_running": is_recognition_running(),
         "students_loaded": recognition_state.get("students_loaded", 0),
         "start_time": recognition_state.get("start_time"),
         "error_message": recognition_state.get("error_message")
@@ -336,7 +917,7 @@ async def start_recognition():
     """
     Starts the face recognition process in a background thread.
     """
-    if recognition_state["is_running"]:
+    if is_recognition_running():
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST, 
             detail="Recognition process is already running. Stop it first before starting a new session."
@@ -358,19 +939,20 @@ async def start_recognition():
 
     try:
         recognition_state["stop_event"] = threading.Event()
+        recognition_state["ready_event"] = threading.Event()
         recognition_state["recognition_thread"] = threading.Thread(
             target=recognition_loop,
-            args=(recognition_state["stop_event"],),
+            args=(recognition_state["stop_event"], recognition_state["ready_event"]),
             daemon=True  # Thread will be killed when main process ends
         )
         recognition_state["recognition_thread"].start()
-        recognition_state["is_running"] = True
         
-        # Wait a moment to check if initialization was successful
-        time.sleep(2)
+        # Wait until the session is running (or failed to start) without blocking the event loop
+        await asyncio.get_running_loop().run_in_executor(
+            None, recognition_state["ready_event"].wait, STARTUP_TIMEOUT
+        )
         
         if recognition_state.get("error_message"):
-            recognition_state["is_running"] = False
             raise HTTPException(
                 status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
                 detail=recognition_state["error_message"]
@@ -387,7 +969,6 @@ async def start_recognition():
         raise
     except Exception as e:
         logger.error(f"API: Error starting recognition: {e}")
-        recognition_state["is_running"] = False
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Failed to start recognition process: {str(e)}"
@@ -398,7 +979,7 @@ async def stop_recognition():
     """
     Stops the background face recognition process and returns the collected attendance data.
     """
-    if not recognition_state["is_running"]:
+    if not is_recognition_running():
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST, 
             detail="Recognition process is not running. Nothing to stop."
@@ -413,15 +994,17 @@ async def stop_recognition():
         if recognition_state["stop_event"]:
             recognition_state["stop_event"].set()
         
-        # Wait for the thread to finish its cleanup (with timeout)
+        # Wait for the thread to finish its cleanup (with timeout) without blocking the event loop
+        still_running = False
         if recognition_state["recognition_thread"]:
-            recognition_state["recognition_thread"].join(timeout=10)
+            await asyncio.get_running_loop().run_in_executor(
+                None, recognition_state["recognition_thread"].join, 10
+            )
             
-            if recognition_state["recognition_thread"].is_alive():
+            still_running = recognition_state["recognition_thread"].is_alive()
+            if still_running:
                 logger.warning("Recognition thread did not stop gracefully within timeout")
         
-        recognition_state["is_running"] = False
-        
         # Calculate session duration
         session_duration = "Unknown"
         if start_time:
@@ -433,33 +1016,53 @@ async def stop_recognition():
                 pass
         
         # Read the final attendance data
-        attendance_data = {"recognizedStudents": []}
-        if os.path.exists(ATTENDANCE_FILE):
-            try:
-                with open(ATTENDANCE_FILE, 'r', encoding='utf-8') as f:
-                    attendance_data = json.load(f)
-            except Exception as e:
-                logger.error(f"Error reading attendance file: {e}")
-                raise HTTPException(
-                    status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                    detail=f"Error reading attendance data: {str(e)}"
-                )
+        try:
+            if still_running:
+                # The session's log hasn't been merged yet, so collect its records and the
+                # unflushed ones too. Read newest first: a record moving on between reads
+                # then shows up twice (and is dropped below) rather than not at all.
+                with attendance_lock:
+                    pending = list(attendance_buffer["pending"])
+                session_records = read_attendance_log() + pending
+            else:
+                session_records = []
+            attendance_data = read_attendance_file()
+        except Exception as e:
+            logger.error(f"Error reading attendance file: {e}")
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail=f"Error reading attendance data: {str(e)}"
+            )
+
+        recognized_students = []
+        seen = set()
+        for rec in attendance_data.get("recognizedStudents", []) + session_records:
+            key = (rec.get("rollNo"), rec.get("timestamp"))
+            if key not in seen:
+                seen.add(key)
+                recognized_students.append(rec)
+
+        message = f"Face recognition process stopped successfully. Session duration: {session_duration}"
+        if still_running:
+            message = (
+                f"Stop requested, but the recognition thread is still shutting down. Session duration: "
+                f"{session_duration}. Records marked so far are included."
+            )
         
         logger.info(f"API: Recognition stopped. Session duration: {session_duration}")
-        logger.info(f"API: Returning attendance data with {len(attendance_data.get('recognizedStudents', []))} records")
+        logger.info(f"API: Returning attendance data with {len(recognized_students)} records")
         
         return StopResponse(
             status="success",
-            message=f"Face recognition process stopped successfully. Session duration: {session_duration}",
+            message=message,
             session_duration=session_duration,
-            recognizedStudents=attendance_data.get("recognizedStudents", [])
+            recognizedStudents=recognized_students
         )
         
     except HTTPException:
         raise
     except Exception as e:
         logger.error(f"API: Error stopping recognition: {e}")
-        recognition_state["is_running"] = False  # Force stop
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Error stopping recognition process: {str(e)}"